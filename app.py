@@ -1,41 +1,99 @@
 import os
-import json
+import math
+import time
+import shutil
 import secrets
+import mimetypes
+import threading
 import datetime as dt
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, wait
 from io import BytesIO
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from flask import (
-    Flask, request, redirect, url_for, render_template_string, send_from_directory,
-    flash, jsonify, abort, send_file
+    Flask, request, redirect, url_for, render_template, send_from_directory, g,
+    flash, jsonify, abort, send_file, Response
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_login import (
     LoginManager, login_user, logout_user, current_user, login_required, UserMixin
 )
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash, safe_join
+from werkzeug.utils import secure_filename
+import orjson
+from cachetools import TTLCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 from sqlalchemy import (
-    create_engine, select, or_, Column, Integer, String, Float, Text,
-    DateTime, ForeignKey, Date, Boolean
+    create_engine, event, select, insert, or_, Column, Integer, String, Float, Text,
+    DateTime, ForeignKey, Date, Boolean, Index, literal_column
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import (
+    declarative_base, relationship, sessionmaker, scoped_session, selectinload, joinedload
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
 
 
 # -------------------- Flask & storage --------------------
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "wellatlas-secret")
 
+# jsonify()/request.get_json() through orjson; DefaultJSONProvider.default still covers
+# Decimal and __html__ objects (dates come out ISO-8601, orjson's native format)
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+app.json = OrjsonProvider(app)
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.environ.get("DATA_DIR", "./data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_URL = f"sqlite:///{os.path.join(DATA_DIR, 'wellatlas.db')}"
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
-SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
+engine = create_engine(DB_URL, connect_args={"check_same_thread": False},
+                       pool_size=10, max_overflow=20)
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets readers and the writer run concurrently across gunicorn workers
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-64000")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+# expire_on_commit=False: views keep reading their objects after commit without a re-SELECT
+SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False,
+                                           expire_on_commit=False))
 
 UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 ALLOWED_EXT = {"png", "jpg", "jpeg", "gif", "pdf", "mp4", "mov"}
+# whole-request cap; larger uploads are rejected with 413 before Werkzeug spools them to disk
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+# Let the front-end server stream uploads instead of a Python worker:
+#   USE_X_SENDFILE=1              -> X-Sendfile (Apache mod_xsendfile, lighttpd)
+#   X_ACCEL_PREFIX=/_protected_uploads/ -> X-Accel-Redirect (nginx `internal` location)
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "") == "1"
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+
+# background disk I/O (multi-file uploads are copied to UPLOAD_DIR in parallel)
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
 
 
 # -------------------- Models --------------------
@@ -45,7 +103,7 @@ class User(UserMixin, Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
     name = Column(String(100))
-    email = Column(String(100), unique=True)
+    email = Column(String(100), unique=True, index=True)
     password_hash = Column(String(200))
     def get_id(self): return str(self.id)
 
@@ -60,26 +118,32 @@ class Site(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(200))
     job_number = Column(String(50), default="")
-    customer_id = Column(Integer, ForeignKey("customers.id"))
+    customer_id = Column(Integer, ForeignKey("customers.id"))  # indexed via ix_site_cust_del_name
     latitude = Column(Float)
     longitude = Column(Float)
     address = Column(Text, default="")
     notes = Column(Text, default="")
     category = Column(String(100), default="")
     status   = Column(String(100), default="")
-    deleted    = Column(Integer, default=0)
+    deleted    = Column(Integer, default=0, index=True)
     deleted_at = Column(String(100), default=None)
     customer = relationship("Customer", back_populates="sites")
     entries  = relationship("Entry", back_populates="site", order_by="Entry.created_at.desc()")
+    __table_args__ = (
+        # map bbox query: range on latitude, then longitude/deleted checked from the index alone
+        Index("ix_sites_lat_lng_del", "latitude", "longitude", "deleted"),
+        # customer_detail: filter on (customer_id, deleted), read back already ordered by name
+        Index("ix_site_cust_del_name", "customer_id", "deleted", "name"),
+    )
 
 class Entry(Base):
     __tablename__ = "entries"
     id = Column(Integer, primary_key=True)
-    site_id = Column(Integer, ForeignKey("sites.id"))
+    site_id = Column(Integer, ForeignKey("sites.id"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     type = Column(String(50), default="general")  # general, well_log, as_built, pump_curve, pump_test, well_test, panel_check
     note = Column(Text, default="")
-    created_at = Column(DateTime, default=dt.datetime.utcnow)
+    created_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
     site = relationship("Site", back_populates="entries")
     user = relationship("User")
     files = relationship("EntryFile", back_populates="entry", order_by="EntryFile.id.asc()")
@@ -87,7 +151,7 @@ class Entry(Base):
 class EntryFile(Base):
     __tablename__ = "entry_files"
     id = Column(Integer, primary_key=True)
-    entry_id = Column(Integer, ForeignKey("entries.id"))
+    entry_id = Column(Integer, ForeignKey("entries.id"), index=True)
     filename = Column(String(255))
     orig_name = Column(String(255), default="")
     mime = Column(String(100), default="")
@@ -103,21 +167,94 @@ class ShareLink(Base):
     revoked = Column(Boolean, default=False)
 
 
-# --- CREATE DB TABLES NOW (safe under Flask 3 + Gunicorn) ---
-try:
+# create_all() won't add or drop indexes on tables that already exist, so older DBs get them here
+INDEX_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_sites_deleted ON sites(deleted)",
+    # superseded by ix_site_cust_del_name, which starts with customer_id
+    "DROP INDEX IF EXISTS ix_sites_customer_id",
+    "CREATE INDEX IF NOT EXISTS ix_entries_site_id ON entries(site_id)",
+    "CREATE INDEX IF NOT EXISTS ix_entries_created_at ON entries(created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_entry_files_entry_id ON entry_files(entry_id)",
+    # partial version replaced by ix_sites_lat_lng_del
+    "DROP INDEX IF EXISTS ix_sites_latlng",
+    "CREATE INDEX IF NOT EXISTS ix_sites_lat_lng_del ON sites(latitude, longitude, deleted)",
+    "CREATE INDEX IF NOT EXISTS ix_site_cust_del_name ON sites(customer_id, deleted, name)",
+]
+
+def ensure_indexes():
+    with engine.begin() as conn:
+        for ddl in INDEX_DDL:
+            conn.exec_driver_sql(ddl)
+
+
+# Bump when create_all()/INDEX_DDL gain something existing DBs need; stored in PRAGMA user_version
+SCHEMA_VERSION = 3
+
+def init_schema():
     Base.metadata.create_all(bind=engine)
-except Exception as e:
-    print(f"[schema init] failed: {e}")
+    ensure_indexes()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+# --- CREATE DB TABLES ON FIRST REQUEST ---
+# Not at import: gunicorn --preload would open the SQLite file in the master before forking.
+# Once per process, and DDL only when the stored version is behind.
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+@app.before_request
+def _ensure_schema_once():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        try:
+            with engine.connect() as conn:
+                current = conn.exec_driver_sql("PRAGMA user_version").scalar()
+            if current < SCHEMA_VERSION:
+                init_schema()
+            _schema_ready = True
+        except Exception:
+            app.logger.exception("Schema init failed")
 
 
 # -------------------- Auth setup --------------------
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
+# one session per request, opened on first use so routes that never query skip it
+def get_db():
+    if "db" not in g:
+        g.db = SessionLocal()
+    return g.db
+
+# current_user for later requests: a detached (id, name, email) snapshot, cached per process
+# so authenticated requests don't re-read the users row (password hash included) every time
+class SessionUser(UserMixin):
+    def __init__(self, id, name, email):
+        self.id, self.name, self.email = id, name, email
+
+USER_CACHE = TTLCache(maxsize=1024, ttl=300)
+USER_CACHE_LOCK = threading.Lock()
+
+def invalidate_user(uid):
+    with USER_CACHE_LOCK:
+        USER_CACHE.pop(uid, None)
+
 @login_manager.user_loader
 def load_user(uid):
-    s = SessionLocal()
-    return s.get(User, int(uid))
+    uid = int(uid)
+    with USER_CACHE_LOCK:
+        u = USER_CACHE.get(uid)
+    if u is None:
+        row = get_db().execute(select(User.id, User.name, User.email).where(User.id==uid)).first()
+        if row is None: return None
+        u = SessionUser(row.id, row.name, row.email)
+        with USER_CACHE_LOCK:
+            USER_CACHE[uid] = u
+    return u
 
 @app.teardown_appcontext
 def remove_session(exc=None):
@@ -125,66 +262,67 @@ def remove_session(exc=None):
 
 
 # -------------------- Helpers --------------------
+# argon2id for new hashes; older Werkzeug (scrypt/pbkdf2) hashes still verify and get upgraded on login
+PASSWORD_HASHER = PasswordHasher()
+
+def hash_password(pw):
+    return PASSWORD_HASHER.hash(pw)
+
+def verify_password(stored, pw):
+    if not stored.startswith("$argon2"):
+        return check_password_hash(stored, pw)
+    try:
+        return PASSWORD_HASHER.verify(stored, pw)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(stored):
+    return not stored.startswith("$argon2") or PASSWORD_HASHER.check_needs_rehash(stored)
+
 def allowed(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
-
-# -------------------- Base layout --------------------
-BASE_HTML = """
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>WellAtlas by Henry Suden</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
-  <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
-  <style>
-    body { margin:0; font-family: Arial, sans-serif; background:#0b3d5c; color:#fff; }
-    nav { background:#0b3d5c; padding:10px 16px; display:flex; gap:14px; align-items:center; position:sticky; top:0; }
-    nav a { color:#fff; text-decoration:none; font-weight:bold; }
-    .wrap { padding:16px; }
-    .flash { background:#fff; color:#000; padding:10px; border-radius:6px; margin:12px 0; }
-    input, select, textarea, button { font-size:16px; padding:8px; border-radius:6px; border:1px solid #ccc; }
-    label { display:block; margin:8px 0 4px; }
-    .card { background:#0e4e76; padding:12px; border-radius:8px; margin:12px 0; }
-    .btn { background:#fff; color:#000; border:none; padding:8px 12px; border-radius:6px; cursor:pointer; font-weight:bold; }
-    .btn.danger { background:#ffb3b3; }
-    table { width:100%; border-collapse:collapse; }
-    th, td { padding:8px; border-bottom:1px solid rgba(255,255,255,0.2); }
-    .map { height: 420px; border-radius:8px; }
-    .small { font-size: 12px; opacity: 0.9; }
-    .right { float:right; }
-  </style>
-</head>
-<body>
-  <nav>
-    <a href="{{ url_for('index') }}">Map</a>
-    <a href="{{ url_for('customers') }}">Customers</a>
-    {% if current_user.is_authenticated %}
-      <a href="{{ url_for('new_customer') }}">New Customer</a>
-      <a href="{{ url_for('new_site') }}">New Site</a>
-      <a href="{{ url_for('deleted') }}">Deleted</a>
-      <a href="{{ url_for('logout') }}">Logout</a>
-    {% else %}
-      <a href="{{ url_for('login') }}">Login</a>
-      <a href="{{ url_for('signup') }}">Sign Up</a>
-    {% endif %}
-  </nav>
-  <div class="wrap">
-    {% with messages = get_flashed_messages(with_categories=true) %}
-      {% if messages %}
-        {% for cat, msg in messages %}<div class="flash">{{ msg }}</div>{% endfor %}
-      {% endif %}
-    {% endwith %}
-    {{ body|safe }}
-  </div>
-</body>
-</html>
-"""
-
-def page(body_html, **ctx):
-    return render_template_string(BASE_HTML, body=body_html, **ctx)
+# unique on-disk name: seconds + random token, then a sanitised copy of the original name
+def upload_name(orig):
+    ext = orig.rsplit(".", 1)[1].lower()
+    base = secure_filename(orig)
+    if not base.lower().endswith("." + ext):  # e.g. non-ASCII names sanitise to just "jpg"
+        base = f"file.{ext}"
+    return f"{int(time.time())}_{secrets.token_hex(8)}_{base}"
+
+def save_upload(stream, path):
+    with open(path, "wb") as dst:
+        shutil.copyfileobj(stream, dst, length=1 << 20)
+
+# Upload names carry a random token and files are never rewritten, so browsers may keep them
+# for a year. `scope` is "private" for logged-in downloads so shared caches never store them.
+def serve_upload(filename, scope="private"):
+    if X_ACCEL_PREFIX:
+        path = safe_join(UPLOAD_DIR, filename)
+        if path is None or not os.path.isfile(path): abort(404)
+        resp = Response(headers={"X-Accel-Redirect": X_ACCEL_PREFIX.rstrip("/") + "/" + quote(filename)})
+        resp.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    else:
+        resp = send_from_directory(UPLOAD_DIR, filename, conditional=True)
+    resp.headers["Cache-Control"] = f"{scope}, max-age=31536000, immutable"
+    return resp
+
+# newest first in SQL; templates start a new date header whenever the day changes.
+# `day` narrows to one calendar day with a created_at range, so SQLite filters via the index
+def get_timeline(db, site_id, day=None):
+    stmt = (select(Entry).where(Entry.site_id==site_id)
+            .order_by(Entry.created_at.desc())
+            .options(selectinload(Entry.files)))
+    if day is not None:
+        start = dt.datetime.combine(day, dt.time.min)
+        stmt = stmt.where(Entry.created_at >= start, Entry.created_at < start + dt.timedelta(days=1))
+    return db.execute(stmt).scalars().all()
+
+
+@app.errorhandler(413)
+def too_large(e):
+    flash(f"Upload too large (limit {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)", "danger")
+    return redirect(request.referrer or url_for("index"))
 
 
 # -------------------- Health & schema --------------------
@@ -195,7 +333,7 @@ def _health():
 @app.get("/admin/ensure_schema")
 def ensure_schema():
     try:
-        Base.metadata.create_all(bind=engine)
+        init_schema()
         return "schema ok", 200
     except Exception as e:
         app.logger.exception("Schema creation failed")
@@ -203,51 +341,85 @@ def ensure_schema():
 
 
 # -------------------- Home / Map --------------------
-@app.route("/")
-def index():
-    s = SessionLocal()
-    q = request.args.get("q", "").strip()
-    stmt = select(Site).where(Site.deleted == 0)
+# serialized map pins per (search, bbox); cleared whenever a site is created, deleted or restored.
+# Bounded by payload bytes, not entry count: a zoomed-out entry can hold nearly every pin.
+PIN_CACHE_BYTES = 16 * 1024 * 1024
+PIN_CACHE = TTLCache(maxsize=PIN_CACHE_BYTES, ttl=60, getsizeof=len)
+PIN_CACHE_LOCK = threading.Lock()
+
+# (min_lat, max_lat, min_lng, max_lng) from the query string, or None for the whole map.
+# The view is grown outward to a grid one map tile wide at zoom `z` (whole degrees without z),
+# so nearby pans and other visitors share a cache key; the map drops pins outside its view.
+def parse_bbox(args):
+    vals = [args.get(k, type=float) for k in ("minLat", "maxLat", "minLng", "maxLng")]
+    # float() takes nan/inf/1e400, which floor()/ceil() below would raise on
+    if any(v is None or not math.isfinite(v) for v in vals):
+        return None
+    min_lat, max_lat, min_lng, max_lng = vals
+    z = args.get("z", type=int)
+    cell = 360.0 / 2 ** min(max(z, 0), 20) if z is not None else 1.0
+    snap = lambda lo, hi: (math.floor(lo / cell) * cell, math.ceil(hi / cell) * cell)
+    min_lat, max_lat = snap(max(min_lat, -90.0), min(max_lat, 90.0))
+    min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+    if max_lng - min_lng >= 360:  # zoomed out past a full world width
+        min_lng, max_lng = -180.0, 180.0
+    else:
+        min_lng, max_lng = snap(max(min_lng, -180.0), min(max_lng, 180.0))
+        min_lng, max_lng = max(min_lng, -180.0), min(max_lng, 180.0)
+    return round(min_lat, 6), round(max_lat, 6), round(min_lng, 6), round(max_lng, 6)
+
+def pins_json(q, bbox=None):
+    key = (q, bbox)
+    with PIN_CACHE_LOCK:
+        payload = PIN_CACHE.get(key)
+    if payload is not None:
+        return payload
+    s = get_db()
+    stmt = (select(Site.id, Site.name, Site.job_number, Site.latitude, Site.longitude)
+            # unary + keeps ix_sites_deleted (nearly every row) out of the planner's choices,
+            # leaving ix_sites_lat_lng_del; drop it and results are the same, just slower
+            .where(literal_column("+sites.deleted") == 0,
+                   Site.latitude.isnot(None), Site.longitude.isnot(None)))
     if q:
         like = f"%{q}%"
         stmt = stmt.where(or_(Site.name.ilike(like), Site.job_number.ilike(like)))
-    sites = s.execute(stmt).scalars().all()
-
-    pins = []
-    for x in sites:
-        if x.latitude is not None and x.longitude is not None:
-            pins.append({
-                "id": x.id, "name": x.name,
-                "job": x.job_number or "",
-                "lat": x.latitude, "lng": x.longitude,
-                "url": url_for("site_detail", site_id=x.id),
-            })
-
-    body = render_template_string("""
-      <h1>WellAtlas Map</h1>
-      <form method="get" action="{{ url_for('index') }}" style="margin:10px 0;">
-        <input name="q" placeholder="Search site or job number" value="{{ q }}">
-        <button class="btn">Search</button>
-      </form>
-      <div id="map" class="map"></div>
-      <p class="small">Tip: Add a site and set coordinates by clicking the map, or use "Locate Me".</p>
-      <script>
-        const pins = {{ pins_json|safe }};
-        var map = L.map('map').setView([37.4, -120], 6);
-        L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', { maxZoom: 19 }).addTo(map);
-        pins.forEach(p => {
-          L.marker([p.lat, p.lng]).addTo(map)
-            .bindPopup(`<b>${p.name}</b><br>Job: ${p.job}<br><a href="${p.url}">Open</a>`);
-        });
-      </script>
-    """, q=q, pins_json=json.dumps(pins))
-    return page(body)
+    if bbox:
+        min_lat, max_lat, min_lng, max_lng = bbox
+        stmt = stmt.where(Site.latitude.between(min_lat, max_lat),
+                          Site.longitude.between(min_lng, max_lng))
+    # plain rows (no ORM objects), fetched in batches straight into the pin list
+    rows = s.execute(stmt.execution_options(yield_per=1000))
+    pins = [{
+        "id": x.id, "name": x.name,
+        "job": x.job_number or "",
+        "lat": x.latitude, "lng": x.longitude,
+        "url": url_for("site_detail", site_id=x.id),
+    } for x in rows]
+    payload = orjson.dumps(pins)
+    if len(payload) <= PIN_CACHE_BYTES:  # TTLCache raises on a single value over maxsize
+        with PIN_CACHE_LOCK:
+            PIN_CACHE[key] = payload
+    return payload
+
+def invalidate_pins():
+    with PIN_CACHE_LOCK:
+        PIN_CACHE.clear()
+
+@app.route("/")
+def index():
+    q = request.args.get("q", "").strip()
+    return render_template("index.html", q=q)
+
+@app.get("/api/pins.json")
+def api_pins():
+    q = request.args.get("q", "").strip()
+    return Response(pins_json(q, parse_bbox(request.args)), mimetype="application/json")
 
 
 # -------------------- Auth --------------------
 @app.route("/signup", methods=["GET","POST"])
 def signup():
-    s = SessionLocal()
+    s = get_db()
     if request.method == "POST":
         name = request.form.get("name","").strip()
         email = request.form.get("email","").strip().lower()
@@ -259,40 +431,25 @@ def signup():
             if exists:
                 flash("Email already registered", "warning")
             else:
-                u = User(name=name, email=email, password_hash=generate_password_hash(password))
-                s.add(u); s.commit(); login_user(u)
+                u = User(name=name, email=email, password_hash=hash_password(password))
+                s.add(u); s.commit(); invalidate_user(u.id); login_user(u)
                 return redirect(url_for("index"))
-    body = """
-    <h2>Sign Up</h2>
-    <form method="post">
-      <label>Name</label><input name="name" required>
-      <label>Email</label><input name="email" type="email" required>
-      <label>Password</label><input name="password" type="password" required>
-      <div style="margin-top:10px"><button class="btn">Create Account</button></div>
-    </form>
-    """
-    return page(body)
+    return render_template("signup.html")
 
 @app.route("/login", methods=["GET","POST"])
 def login():
-    s = SessionLocal()
+    s = get_db()
     if request.method == "POST":
         email = request.form.get("email","").strip().lower()
         pw = request.form.get("password","")
         u = s.execute(select(User).where(User.email==email)).scalar_one_or_none()
-        if u and check_password_hash(u.password_hash, pw):
+        if u and verify_password(u.password_hash, pw):
+            if password_needs_rehash(u.password_hash):
+                u.password_hash = hash_password(pw); s.commit()
             login_user(u, remember=True)
             return redirect(request.args.get("next") or url_for("index"))
         flash("Invalid email or password", "danger")
-    body = """
-    <h2>Login</h2>
-    <form method="post">
-      <label>Email</label><input name="email" type="email" required>
-      <label>Password</label><input name="password" type="password" required>
-      <div style="margin-top:10px"><button class="btn">Login</button></div>
-    </form>
-    """
-    return page(body)
+    return render_template("login.html")
 
 @app.get("/logout")
 def logout():
@@ -304,82 +461,50 @@ def logout():
 @app.get("/customers")
 @login_required
 def customers():
-    s = SessionLocal()
+    s = get_db()
     cs = s.execute(select(Customer).order_by(Customer.name.asc())).scalars().all()
-    body = render_template_string("""
-    <h2>Customers</h2>
-    <p><a class="btn" href="{{ url_for('new_customer') }}">+ New Customer</a></p>
-    <table>
-      <tr><th>Name</th><th></th></tr>
-      {% for c in cs %}
-        <tr>
-          <td>{{ c.name }}</td>
-          <td><a class="btn" href="{{ url_for('customer_detail', customer_id=c.id) }}">Open</a></td>
-        </tr>
-      {% else %}
-        <tr><td colspan="2">No customers yet</td></tr>
-      {% endfor %}
-    </table>
-    """, cs=cs)
-    return page(body)
+    return render_template("customers.html", cs=cs)
 
 @app.route("/customers/new", methods=["GET","POST"])
 @login_required
 def new_customer():
-    s = SessionLocal()
+    s = get_db()
     if request.method == "POST":
         name = request.form.get("name","").strip()
         if not name:
             flash("Name is required", "danger")
         else:
-            ex = s.execute(select(Customer).where(Customer.name==name)).scalar_one_or_none()
-            if ex:
+            # one statement; the unique name index decides, even with two workers racing
+            res = s.execute(sqlite_insert(Customer).values(name=name)
+                            .on_conflict_do_nothing(index_elements=["name"]))
+            s.commit()
+            if res.rowcount == 0:
                 flash("Customer already exists", "warning")
             else:
-                s.add(Customer(name=name)); s.commit()
                 flash("Customer added", "success")
                 return redirect(url_for("customers"))
-    body = """
-    <h2>New Customer</h2>
-    <form method="post">
-      <label>Name</label><input name="name" required>
-      <div style="margin-top:10px"><button class="btn">Save</button></div>
-    </form>
-    """
-    return page(body)
+    return render_template("new_customer.html")
 
 @app.get("/customers/<int:customer_id>")
 @login_required
 def customer_detail(customer_id):
-    s = SessionLocal()
+    s = get_db()
     c = s.get(Customer, customer_id)
     if not c:
         flash("Customer not found", "warning"); return redirect(url_for("customers"))
-    sites = [x for x in c.sites if not x.deleted]
-    body = render_template_string("""
-    <h2>Customer: {{ c.name }}</h2>
-    <p><a class="btn" href="{{ url_for('new_site') }}">+ New Site</a></p>
-    <table>
-      <tr><th>Site</th><th>Job #</th><th></th></tr>
-      {% for x in sites %}
-        <tr>
-          <td>{{ x.name }}</td>
-          <td>{{ x.job_number or '' }}</td>
-          <td><a class="btn" href="{{ url_for('site_detail', site_id=x.id) }}">Open</a></td>
-        </tr>
-      {% else %}
-        <tr><td colspan="3">No sites</td></tr>
-      {% endfor %}
-    </table>
-    """, c=c, sites=sites)
-    return page(body)
+    sites = s.execute(
+        select(Site.id, Site.name, Site.job_number)
+        .where(Site.customer_id==customer_id, Site.deleted==0)
+        .order_by(Site.name.asc())
+    ).all()
+    return render_template("customer_detail.html", c=c, sites=sites)
 
 
 # -------------------- Sites --------------------
 @app.route("/sites/new", methods=["GET","POST"])
 @login_required
 def new_site():
-    s = SessionLocal()
+    s = get_db()
     customers = s.execute(select(Customer).order_by(Customer.name.asc())).scalars().all()
     if request.method == "POST":
         cid = int(request.form["customer_id"])
@@ -396,194 +521,52 @@ def new_site():
             s.add(Site(name=name, job_number=job, customer_id=cid, latitude=lat, longitude=lng,
                        address=addr, category=cat, status=stat))
             s.commit()
+            invalidate_pins()
             flash("Site created", "success")
             return redirect(url_for("index"))
-    body = render_template_string("""
-    <h2>New Site</h2>
-    <form method="post">
-      <label>Customer</label>
-      <select name="customer_id">
-        {% for c in customers %}
-          <option value="{{ c.id }}">{{ c.name }}</option>
-        {% endfor %}
-      </select>
-
-      <label>Site Name</label><input name="name" required>
-      <label>Job #</label><input name="job_number">
-      <label>Latitude</label><input name="latitude" id="lat" required>
-      <label>Longitude</label><input name="longitude" id="lng" required>
-
-      <div id="pickmap" class="map" style="margin:10px 0;"></div>
-      <button type="button" class="btn" onclick="locateMe()">📍 Locate Me</button>
-
-      <label>Address</label><input name="address">
-      <label>Category</label><input name="category">
-      <label>Status</label><input name="status">
-
-      <div style="margin-top:10px"><button class="btn">Save</button></div>
-    </form>
-
-    <script>
-      var map = L.map('pickmap').setView([37.4, -120], 6);
-      L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {maxZoom:19}).addTo(map);
-      var m=null;
-      function setMarker(lat,lng){ if(m) map.removeLayer(m); m=L.marker([lat,lng]).addTo(map);
-        document.getElementById('lat').value=lat; document.getElementById('lng').value=lng; }
-      map.on('click', e => setMarker(e.latlng.lat.toFixed(6), e.latlng.lng.toFixed(6)));
-      function locateMe(){ if(navigator.geolocation){
-        navigator.geolocation.getCurrentPosition(p=>{
-          setMarker(p.coords.latitude.toFixed(6), p.coords.longitude.toFixed(6));
-          map.setView([p.coords.latitude,p.coords.longitude], 15);
-        }); } }
-    </script>
-    """, customers=customers)
-    return page(body)
+    return render_template("new_site.html", customers=customers)
 
 @app.get("/sites/<int:site_id>")
 @login_required
 def site_detail(site_id):
-    s = SessionLocal()
-    site = s.get(Site, site_id)
+    s = get_db()
+    site = s.get(Site, site_id, options=[joinedload(Site.customer)])
     if not site or site.deleted:
         flash("Site not found", "warning"); return redirect(url_for("index"))
-
-    # group entries by date
-    groups = {}
-    for e in site.entries:
-        d = e.created_at.date().isoformat()
-        groups.setdefault(d, []).append(e)
-    for d in list(groups.keys()):
-        groups[d].sort(key=lambda x: x.created_at, reverse=True)
-
-    body = render_template_string("""
-    <h2>{{ site.name }} <span class="small">({{ site.job_number or '' }})</span></h2>
-
-    <form class="right" method="post" action="{{ url_for('delete_site', site_id=site.id) }}"
-          onsubmit="return confirm('Move this site to Deleted?')">
-      <button class="btn danger">Delete Site</button>
-    </form>
-
-    <p>Customer: {{ site.customer.name if site.customer else '—' }}<br>
-       Lat/Lng: {{ site.latitude }}, {{ site.longitude }}</p>
-
-    <div class="card">
-      <h3>Add Entry</h3>
-      <form method="post" action="{{ url_for('add_entry', site_id=site.id) }}" enctype="multipart/form-data">
-        <label>Type</label>
-        <select name="type">
-          <option value="general">General</option>
-          <option value="well_log">Well Log</option>
-          <option value="as_built">As Built / Well Design</option>
-          <option value="pump_curve">Pump Curve</option>
-          <option value="pump_test">Pump Test</option>
-          <option value="well_test">Well Test</option>
-          <option value="panel_check">Panel Check</option>
-        </select>
-        <label>Note</label><textarea name="note"></textarea>
-        <label>Files (you can select multiple)</label><input type="file" name="files" multiple>
-        <div style="margin-top:10px"><button class="btn">Add</button></div>
-      </form>
-
-      <form method="post" action="{{ url_for('create_share_site', site_id=site.id) }}" style="margin-top:10px">
-        <button class="btn">Create Public Link (Whole Site)</button>
-      </form>
-
-      <form method="post" action="{{ url_for('create_share_day', site_id=site.id) }}" style="margin-top:8px">
-        <label>Share a specific day</label>
-        <input type="date" name="date" required>
-        <button class="btn">Create Day Link</button>
-      </form>
-    </div>
-
-    <h3>Timeline</h3>
-    {% for d, items in groups|dictsort(reverse=True) %}
-      <h3>{{ d }}</h3>
-      {% for e in items %}
-        <div class="card">
-          <div><b>{{ e.type }}</b> — {{ e.created_at.strftime('%Y-%m-%d %H:%M:%S') }}</div>
-          <div>{{ e.note or '' }}</div>
-          {% if e.files %}
-            <ul>
-              {% for f in e.files %}
-                <li>
-                  <a href="{{ url_for('uploaded_file', filename=f.filename) }}" target="_blank">{{ f.orig_name }}</a>
-                  <form method="post" action="{{ url_for('save_file_comment', file_id=f.id) }}" style="display:inline" onsubmit="return saveComment(event, {{ f.id }})">
-                    <input name="comment" value="{{ (f.comment or '') }}">
-                    <button class="btn">Save</button>
-                  </form>
-                </li>
-              {% endfor %}
-            </ul>
-          {% else %}
-            <i>No files</i>
-          {% endif %}
-        </div>
-      {% else %}
-        <i>No entries</i>
-      {% endfor %}
-    {% endfor %}
-
-    <script>
-      async function saveComment(ev, fid){
-        ev.preventDefault();
-        const form = ev.target;
-        const data = new FormData(form);
-        const r = await fetch(form.action, {method:'POST', body:data});
-        if(r.ok) alert('Saved'); else alert('Failed');
-        return false;
-      }
-    </script>
-    """, site=site, groups=groups)
-    return page(body)
+    entries = get_timeline(s, site_id)
+    return render_template("site_detail.html", site=site, entries=entries)
 
 @app.post("/sites/<int:site_id>/delete")
 @login_required
 def delete_site(site_id):
-    s = SessionLocal()
+    s = get_db()
     site = s.get(Site, site_id)
     if not site:
         flash("Site not found", "warning"); return redirect(url_for("index"))
     site.deleted = 1
     site.deleted_at = dt.datetime.utcnow().isoformat(timespec="seconds")
     s.commit()
+    invalidate_pins()
     flash("Site moved to Deleted", "info")
     return redirect(url_for("index"))
 
 @app.get("/deleted")
 @login_required
 def deleted():
-    s = SessionLocal()
+    s = get_db()
     sites = s.execute(select(Site).where(Site.deleted==1)).scalars().all()
-    body = render_template_string("""
-    <h2>Deleted Sites</h2>
-    <table>
-      <tr><th>Site</th><th>Job #</th><th></th></tr>
-      {% for x in sites %}
-        <tr>
-          <td>{{ x.name }}</td>
-          <td>{{ x.job_number or '' }}</td>
-          <td>
-            <form method="post" action="{{ url_for('restore_site', site_id=x.id) }}">
-              <button class="btn">Restore</button>
-            </form>
-          </td>
-        </tr>
-      {% else %}
-        <tr><td colspan="3">None</td></tr>
-      {% endfor %}
-    </table>
-    """, sites=sites)
-    return page(body)
+    return render_template("deleted.html", sites=sites)
 
 @app.post("/sites/<int:site_id>/restore")
 @login_required
 def restore_site(site_id):
-    s = SessionLocal()
+    s = get_db()
     site = s.get(Site, site_id)
     if site and site.deleted:
         site.deleted = 0
         site.deleted_at = None
         s.commit()
+        invalidate_pins()
         flash("Restored", "success")
     return redirect(url_for("deleted"))
 
@@ -592,21 +575,36 @@ def restore_site(site_id):
 @app.post("/sites/<int:site_id>/entries")
 @login_required
 def add_entry(site_id):
-    s = SessionLocal()
+    s = get_db()
     site = s.get(Site, site_id)
     if not site:
         flash("Site not found", "warning"); return redirect(url_for("index"))
     etype = request.form.get("type","general")
     note  = request.form.get("note","").strip()
     e = Entry(site_id=site_id, user_id=current_user.id, type=etype, note=note)
-    s.add(e); s.commit()
+    s.add(e); s.flush()  # id for the file rows; entry and files commit together below
     files = request.files.getlist("files")
+    saved, paths, jobs = [], [], []
     for f in files:
         if f and allowed(f.filename):
-            safe = f"{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_{f.filename.replace(' ','_')}"
+            safe = upload_name(f.filename)
             path = os.path.join(UPLOAD_DIR, safe)
-            f.save(path)
-            s.add(EntryFile(entry_id=e.id, filename=safe, orig_name=f.filename, mime=f.mimetype, comment=""))
+            jobs.append(EXECUTOR.submit(save_upload, f.stream, path))
+            paths.append(path)
+            saved.append({"entry_id": e.id, "filename": safe, "orig_name": f.filename,
+                          "mime": f.mimetype, "comment": ""})
+    # let every copy finish before looking at errors, so none is still writing while we clean up
+    wait(jobs)
+    failed = [job.exception() for job in jobs if job.exception() is not None]
+    if failed:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise failed[0]  # the uncommitted entry is rolled back at teardown
+    if saved:
+        s.execute(insert(EntryFile), saved)
     s.commit()
     flash("Entry added", "success")
     return redirect(url_for("site_detail", site_id=site_id))
@@ -614,7 +612,7 @@ def add_entry(site_id):
 @app.post("/entries/<int:file_id>/comment")
 @login_required
 def save_file_comment(file_id):
-    s = SessionLocal()
+    s = get_db()
     ef = s.get(EntryFile, file_id)
     if not ef: return jsonify({"ok":False}), 404
     ef.comment = request.form.get("comment","")
@@ -624,12 +622,12 @@ def save_file_comment(file_id):
 @app.get("/uploads/<path:filename>")
 @login_required
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_DIR, filename)
+    return serve_upload(filename)
 
 
 # -------------------- Public sharing --------------------
 def get_or_create_share(site, share_date=None, sdb=None):
-    db = sdb or SessionLocal()
+    db = sdb or get_db()
     q = select(ShareLink).where(ShareLink.site_id==site.id, ShareLink.revoked==False)
     if share_date is None: q = q.where(ShareLink.date.is_(None))
     else: q = q.where(ShareLink.date==share_date)
@@ -640,17 +638,37 @@ def get_or_create_share(site, share_date=None, sdb=None):
     db.add(sl); db.commit()
     return sl
 
+# (token, site_id) -> date the live link covers (None = whole site); a shared page's
+# file requests all hit the same key, so only the first one queries share_links
+SHARE_CACHE = TTLCache(maxsize=1024, ttl=300)
+SHARE_CACHE_LOCK = threading.Lock()
+_NO_SHARE = object()
+
+def share_link_date(token, site_id, sdb=None):
+    key = (token, site_id)
+    with SHARE_CACHE_LOCK:
+        d = SHARE_CACHE.get(key, _NO_SHARE)
+    if d is not _NO_SHARE:
+        return d
+    db = sdb or get_db()
+    row = db.execute(
+        select(ShareLink.date).where(ShareLink.token==token, ShareLink.site_id==site_id,
+                                     ShareLink.revoked==False)
+    ).first()
+    if row is None:
+        return _NO_SHARE  # misses aren't cached, so a brand-new link works immediately
+    with SHARE_CACHE_LOCK:
+        SHARE_CACHE[key] = row.date
+    return row.date
+
 def verify_token_for_site(token, site_id, share_date=None, sdb=None):
-    db = sdb or SessionLocal()
-    q = select(ShareLink).where(ShareLink.token==token, ShareLink.site_id==site_id, ShareLink.revoked==False)
-    if share_date is None: q = q.where(ShareLink.date.is_(None))
-    else: q = q.where(ShareLink.date==share_date)
-    return db.execute(q).scalar_one_or_none()
+    d = share_link_date(token, site_id, sdb)
+    return d is not _NO_SHARE and d == share_date
 
 @app.post("/sites/<int:site_id>/share/site")
 @login_required
 def create_share_site(site_id):
-    db = SessionLocal()
+    db = get_db()
     site = db.get(Site, site_id) or abort(404)
     sl = get_or_create_share(site, None, db)
     url = url_for('public_share_site', site_id=site_id, _external=True) + f"?token={sl.token}"
@@ -660,7 +678,7 @@ def create_share_site(site_id):
 @app.post("/sites/<int:site_id>/share/day")
 @login_required
 def create_share_day(site_id):
-    db = SessionLocal()
+    db = get_db()
     site = db.get(Site, site_id) or abort(404)
     try:
         d = dt.date.fromisoformat(request.form.get("date"))
@@ -673,48 +691,18 @@ def create_share_day(site_id):
 
 @app.get("/share/site/<int:site_id>")
 def public_share_site(site_id):
-    db = SessionLocal()
+    db = get_db()
     token = request.args.get("token","")
     sl = verify_token_for_site(token, site_id, None, db)
     if not sl: abort(403)
     site = db.get(Site, site_id)
     if not site or site.deleted: abort(404)
-
-    groups = {}
-    for e in site.entries:
-        d = e.created_at.date().isoformat()
-        groups.setdefault(d, []).append(e)
-    for k in list(groups.keys()):
-        groups[k].sort(key=lambda x: x.created_at, reverse=True)
-
-    body = render_template_string("""
-    <h2>Shared: {{ site.name }}</h2>
-    {% for d, items in groups|dictsort(reverse=True) %}
-      <h3>{{ d }}</h3>
-      {% for e in items %}
-        <div class="card">
-          <div><b>{{ e.type }}</b> — {{ e.created_at.strftime('%Y-%m-%d %H:%M:%S') }}</div>
-          <div>{{ e.note or '' }}</div>
-          {% if e.files %}
-            <ul>
-              {% for f in e.files %}
-                <li><a href="{{ url_for('share_file', token=token, file_id=f.id) }}" target="_blank">{{ f.orig_name }}</a></li>
-              {% endfor %}
-            </ul>
-          {% else %}
-            <i>No files</i>
-          {% endif %}
-        </div>
-      {% else %}
-        <i>No entries</i>
-      {% endfor %}
-    {% endfor %}
-    """, site=site, groups=groups, token=token)
-    return page(body)
+    entries = get_timeline(db, site_id)
+    return render_template("public_share_site.html", site=site, entries=entries, token=token)
 
 @app.get("/share/site/<int:site_id>/day/<date_str>")
 def public_share_day(site_id, date_str):
-    db = SessionLocal()
+    db = get_db()
     token = request.args.get("token","")
     try:
         d = dt.date.fromisoformat(date_str)
@@ -724,53 +712,25 @@ def public_share_day(site_id, date_str):
     if not sl: abort(403)
     site = db.get(Site, site_id)
     if not site or site.deleted: abort(404)
-
-    entries = [e for e in site.entries if e.created_at.date()==d]
-    body = render_template_string("""
-    <h2>Shared: {{ site.name }} — {{ d.isoformat() }}</h2>
-    {% for e in entries|sort(attribute='created_at', reverse=True) %}
-      <div class="card">
-        <div><b>{{ e.type }}</b> — {{ e.created_at.strftime('%Y-%m-%d %H:%M:%S') }}</div>
-        <div>{{ e.note or '' }}</div>
-        {% if e.files %}
-          <ul>
-            {% for f in e.files %}
-              <li><a href="{{ url_for('share_file', token=token, file_id=f.id) }}" target="_blank">{{ f.orig_name }}</a></li>
-            {% endfor %}
-          </ul>
-        {% else %}
-          <i>No files</i>
-        {% endif %}
-      </div>
-    {% else %}
-      <i>No entries</i>
-    {% endfor %}
-    """, site=site, entries=entries, d=d, token=token)
-    return page(body)
+    entries = get_timeline(db, site_id, d)
+    return render_template("public_share_day.html", site=site, entries=entries, d=d, token=token)
 
 @app.get("/share/file/<token>/<int:file_id>")
 def share_file(token, file_id):
-    db = SessionLocal()
-    ef = db.get(EntryFile, file_id) or abort(404)
-    entry = db.get(Entry, ef.entry_id) or abort(404)
-    sl = db.execute(
-        select(ShareLink).where(
-            ShareLink.token==token,
-            ShareLink.site_id==entry.site_id,
-            ShareLink.revoked==False
-        )
-    ).scalar_one_or_none()
-    if not sl: abort(403)
-    if sl.date is not None and entry.created_at.date()!=sl.date: abort(403)
-    return send_from_directory(UPLOAD_DIR, ef.filename, as_attachment=False)
+    db = get_db()
+    row = db.execute(
+        select(EntryFile.filename, Entry.site_id, Entry.created_at)
+        .join(Entry, Entry.id==EntryFile.entry_id)
+        .where(EntryFile.id==file_id)
+    ).first() or abort(404)
+    d = share_link_date(token, row.site_id, db)
+    if d is _NO_SHARE: abort(403)
+    if d is not None and row.created_at.date()!=d: abort(403)
+    return serve_upload(row.filename, scope="public")
 
 
 # -------------------- Local run --------------------
 if __name__ == "__main__":
-    try:
-        Base.metadata.create_all(bind=engine)
-    except Exception as e:
-        print(f"[local schema] failed: {e}")
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
 